@@ -1,6 +1,5 @@
 import pygame
 import math
-import numpy as np
 
 
 class Point:
@@ -55,8 +54,8 @@ def draw_text(screen, text, xy, font_size=30, colour=(255, 255, 255), font=None)
 
 def draw_rect(screen, colour, rect, direction=(1, 0), thickness=0):
     x, y, l, w = rect
-    xy = np.array(((x, y - w/2), (x, y + w/2), (x + l, y + w/2), (x + l, y - w/2)))
     c, s = direction
-    rot = np.array(((c, -s), (s, c)))
-    xy = (rot @ (xy - (x, y)).T).T + (x, y)
+    # Corners relative to (x, y), rotated by direction, with scalar maths (no per-call arrays)
+    corners = ((0, -w/2), (0, w/2), (l, w/2), (l, -w/2))
+    xy = [(x + c * px - s * py, y + s * px + c * py) for px, py in corners]
     return pygame.draw.polygon(screen, colour, xy, thickness)
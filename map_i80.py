@@ -1,5 +1,6 @@
 # from os import getpid, system
 from os.path import isfile
+import math
 
 import torch
 from random import choice, randrange
@@ -10,7 +11,6 @@ import pygame
 import pandas as pd
 import numpy as np
 import pdb, random
-import bisect
 import pdb, pickle, os, re
 
 # Conversion LANE_W from real world to pixels
@@ -80,7 +80,7 @@ class I80Car(Car):
 
     def _get(self, what, k):
         direction_vector = self._trajectory[k + 1] - self._trajectory[k]
-        norm = np.linalg.norm(direction_vector)
+        norm = math.hypot(direction_vector[0], direction_vector[1])
         if what == 'direction':
             if norm < 1e-6: return self._direction  # if static returns previous direction
             return direction_vector / norm
@@ -91,7 +91,7 @@ class I80Car(Car):
             while self._df.at[self._df.index[t], 'Vehicle Velocity'] < 5 and t < self._max_t: t += 1
             # t point to the point in time where speed is > 5
             direction_vector = self._trajectory[t] - self._trajectory[t - 1]
-            norm = np.linalg.norm(direction_vector)
+            norm = math.hypot(direction_vector[0], direction_vector[1])
             # assert norm > 1e-6, f'norm: {norm} -> too small!'
             if norm < 1e-6:
                 print(f'{self} has undefined direction, assuming horizontal')
@@ -135,8 +135,8 @@ class I80Car(Car):
     def action_clipping(self, a, b):
         max_a = self.max_a
         max_b = self.max_b * min((25 / self._length) ** 2, 1)
-        a = a if abs(a) < max_a else np.sign(a) * max_a
-        b = b if abs(b) < max_b else np.sign(b) * max_b
+        a = a if abs(a) < max_a else math.copysign(max_a, a)
+        b = b if abs(b) < max_b else math.copysign(max_b, b)
         return a, b
 
     @property
@@ -396,19 +396,22 @@ class I80(Simulator):
         if self.show_frame_count:
             print(f'\r[t={self.frame}]', end='')
 
-        for v in self.vehicles[:]:
+        on_screen = list()
+        for v in self.vehicles:
             if v.off_screen:
                 # print(f'vehicle {v.id} [off screen]')
                 if self.state_image and self.store:
                     file_name = os.path.join(self.data_dir, self.DUMP_NAME, os.path.basename(self._t_slot))
                     print(f'[dumping {v} in {file_name}]')
                     v.dump_state_image(file_name, 'tensor')
-                self.vehicles.remove(v)
             else:
-                # Insort it in my vehicle list
+                # Add it to my vehicle list
                 lane_idx = v.current_lane
                 assert v.current_lane < self.nb_lanes, f'{v} is in lane {v.current_lane} at frame {self.frame}'
-                bisect.insort(self.lane_occupancy[lane_idx], v)
+                self.lane_occupancy[lane_idx].append(v)
+                on_screen.append(v)
+        self.vehicles = on_screen  # drop off screen vehicles in a single pass
+        for lane in self.lane_occupancy: lane.sort()  # sort once, rather than insort each vehicle
 
         if self.state_image or self.controlled_car and self.controlled_car['locked']:
             # How much to look far ahead
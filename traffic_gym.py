@@ -11,6 +11,10 @@ import sys, pickle
 import PIL
 from PIL import Image
 from custom_graphics import draw_dashed_line, draw_text, draw_rect
+try:  # ahead-of-time compiled kernels, see traffic_kernels.py (rebuild them after editing that file)
+    from _traffic_kernels import advance
+except ImportError:
+    from traffic_kernels import advance
 from gym import core, spaces
 import os
 from imageio import imwrite
@@ -78,7 +82,7 @@ class Car:
         lane = random.choice(tuple(free_lanes))
         if lane == 6 and type(self).__name__ == 'PatchedCar':
             self._position = np.array((0, lanes[-1]['max'] + 42), np.float)
-            self._direction = np.array((1, -0.035), np.float) / np.sqrt(1 + 0.035 ** 2)
+            self._direction = np.array((1, -0.035), np.float) / math.hypot(1, 0.035)
         else:
             self._position = np.array((
                 -self._length,
@@ -112,6 +116,7 @@ class Car:
         self.policy_network = policy_network
         self.is_controlled = False
         self.collisions_per_frame = 0
+        self._lane_set = set()  # lanes this car is registered in, within the simulator lane_occupancy
 
     @staticmethod
     def get_text(n, font):
@@ -133,12 +138,14 @@ class Car:
         :param other: the guy in front of me
         :return: cost
         """
-        d = self._direction
-        d_o = np.array((self._direction[1], -self._direction[0]))  # ortho direction, pointing left
+        dx, dy = self._direction  # ortho direction, pointing left, is (dy, -dx)
+        # other - self, as scalars
+        ox = other._position[0] - (self._position[0] + self._length * dx)
+        oy = other._position[1] - (self._position[1] + self._length * dy)
         # max(0, .) required because my.front can > other.back
-        cost_ahead = max(0, 1 - max(0, (other - self) @ d) / self.safe_distance)
+        cost_ahead = max(0, 1 - max(0, ox * dx + oy * dy) / self.safe_distance)
         # abs() required because there are cars on the right too
-        cost_sideways = max(0, 1 - abs((other - self) @ d_o) / self.LANE_W)
+        cost_sideways = max(0, 1 - abs(ox * dy - oy * dx) / self.LANE_W)
 
         return cost_ahead * cost_sideways
 
@@ -223,7 +230,7 @@ class Car:
         :param mode: human or machine
         :param offset: for representation cropping
         """
-        x, y = self._position + offset
+        x, y = self._position[0] + offset, self._position[1] + offset
         rectangle = (int(x), int(y), self._length, self._width)
 
         d = self._direction
@@ -250,7 +257,7 @@ class Car:
             _r = draw_rect(surface, self._colour, rectangle, d)
 
             # Drawing vehicle number
-            if x < self.front[0]:
+            if x < self._front_x:
                 self._text[1].left = x
             else:
                 self._text[1].right = x
@@ -273,14 +280,8 @@ class Car:
         # Actions: acceleration (a), steering (b)
         a, b = action
 
-        # State integration
-        self._position += self._speed * self._direction * self._dt
-
-        ortho_direction = np.array((self._direction[1], -self._direction[0]))
-        direction_vector = self._direction + ortho_direction * b * self._speed * self._dt
-        self._direction = direction_vector / (np.linalg.norm(direction_vector) + 1e-3)
-
-        self._speed += a * self._dt
+        # State integration (position, direction, speed), compiled kernel
+        self._speed = advance(self._position, self._direction, float(self._speed), float(a), float(b), self._dt)
 
         # Deal with latent variable and visual indicator
         if self._passing and abs(self._error) < 0.5:
@@ -296,11 +297,29 @@ class Car:
         busy_lanes = set()
         y = self._position[1]
         half_w = self._width // 2
-        for lane_idx, lane in enumerate(lanes):
-            if lane['min'] <= y - half_w <= lane['max'] or lane['min'] <= y + half_w <= lane['max']:
+        # Lanes are uniform strips, hence the lane of each car side is a single integer division
+        top = lanes[0]['min']
+        lane_w = lanes[0]['max'] - top
+        nb_lanes = len(lanes)
+        for side in (y - half_w, y + half_w):
+            lane_idx, remainder = divmod(side - top, lane_w)
+            lane_idx = int(lane_idx)
+            if 0 <= lane_idx < nb_lanes:
                 busy_lanes.add(lane_idx)
+            if remainder == 0 and 0 < lane_idx <= nb_lanes:  # on a lane boundary, it belongs to both lanes
+                busy_lanes.add(lane_idx - 1)
         return busy_lanes
 
+    def get_lane_mask(self):
+        """
+        Returns the lanes this car is registered in as a bit mask, bit l set <-> lane l
+        :return: busy lanes mask
+        """
+        mask = 0
+        for lane_idx in self._lane_set:
+            mask |= 1 << lane_idx
+        return mask
+
     @property
     def safe_distance(self):
         return abs(self._speed) * self._safe_factor + 1 * self.SCALE  # plus one metre
@@ -313,6 +332,10 @@ class Car:
     def back(self):
         return self._position
 
+    @property
+    def _front_x(self):
+        return self._position[0] + self._length * self._direction[0]
+
     def _brake(self, fraction):
         if self._passing: return 0
         # Maximum braking acceleration, eq. (1) from
@@ -341,13 +364,19 @@ class Car:
         """
         Check if self is in front of other: self.front[0] > other.front[0]
         """
-        return self.front[0] > other.front[0]
+        return self._front_x > other._front_x
 
     def __lt__(self, other):
         """
         Check if self is behind of other: self.front[0] < other.front[0]
         """
-        return self.front[0] < other.front[0]
+        return self._front_x < other._front_x
+
+    def distance_to(self, other):
+        """
+        Return the longitudinal gap between my front and the back of other, the guy in front of me
+        """
+        return other._position[0] - self._front_x
 
     def __sub__(self, other):
         """
@@ -367,25 +396,21 @@ class Car:
         :return: acceleration, d_theta
         """
         a = 0
+        safe_distance = self.safe_distance  # speed is constant until the next step
 
         car_ahead = observation[1][1]
         if car_ahead:
-            distance = (car_ahead - self)[0]
-            if self.safe_distance > distance > 0:
-                if random.random() < 0.5:
-                    if self._safe_left(observation):
-                        self._pass_left()
-                    elif self._safe_right(observation):
-                        self._pass_right()
-                    else:
-                        a = self._brake(min((self.safe_distance / distance) ** 0.2 - 1, 1))
+            distance = self.distance_to(car_ahead)
+            if safe_distance > distance > 0:
+                # Pass on either side (left first with 50% chance), brake otherwise
+                manoeuvres = (self._safe_left, self._pass_left), (self._safe_right, self._pass_right)
+                if random.random() >= 0.5: manoeuvres = manoeuvres[::-1]
+                for is_safe, do_pass in manoeuvres:
+                    if is_safe(observation):
+                        do_pass()
+                        break
                 else:
-                    if self._safe_right(observation):
-                        self._pass_right()
-                    elif self._safe_left(observation):
-                        self._pass_left()
-                    else:
-                        a = self._brake(min((self.safe_distance / distance) ** 0.2 - 1, 1))
+                    a = self._brake(min((safe_distance / distance) ** 0.2 - 1, 1))
 
             elif distance <= 0:
                 self._colour = colours['r']
@@ -410,26 +435,28 @@ class Car:
         d_error = error - self._error
         d_clip = 2
         if abs(d_error) > d_clip:
-            d_error *= d_clip / abs(d_error)
+            d_error = math.copysign(d_clip, d_error)
         self._error = error
         b = self.pid_k1 * error + self.pid_k2 * d_error
         action = np.array((a, b))  # dx/dt, car state temporal derivative
         return action
 
     def _safe_left(self, state):
-        if self.back[0] < self.safe_distance: return False  # Cannot see in the future
         if self._passing: return False
         if state[0] is None: return False  # On the leftmost lane
-        if state[0][0] and (self - state[0][0])[0] < state[0][0].safe_distance: return False
-        if state[0][1] and (state[0][1] - self)[0] < self.safe_distance: return False
+        safe_distance = self.safe_distance
+        if self.back[0] < safe_distance: return False  # Cannot see in the future
+        if state[0][0] and state[0][0].distance_to(self) < state[0][0].safe_distance: return False
+        if state[0][1] and self.distance_to(state[0][1]) < safe_distance: return False
         return True
 
     def _safe_right(self, state):
-        if self.back[0] < self.safe_distance: return False  # Cannot see in the future
         if self._passing: return False
         if state[2] is None: return False  # On the rightmost lane
-        if state[2][0] and (self - state[2][0])[0] < state[2][0].safe_distance: return False
-        if state[2][1] and (state[2][1] - self)[0] < self.safe_distance: return False
+        safe_distance = self.safe_distance
+        if self.back[0] < safe_distance: return False  # Cannot see in the future
+        if state[2][0] and state[2][0].distance_to(self) < state[2][0].safe_distance: return False
+        if state[2][1] and self.distance_to(state[2][1]) < safe_distance: return False
         return True
 
     def _get_observation_image(self, m, screen_surface, width_height, scale, global_frame):
@@ -443,9 +470,9 @@ class Car:
             print(f'{self} fucked up')  # notify about the event
             self.off_screen = True  # we're off_screen
             return self._states_image[-1]  # return last state
-        theta = np.arctan2(*d[::-1]) * 180 / np.pi  # in degrees
+        theta = math.degrees(math.atan2(d[1], d[0]))  # in degrees
         rot_surface = pygame.transform.rotate(sub_surface, theta)
-        width_height = np.floor(np.array(width_height))
+        width_height = math.floor(width_height[0]), math.floor(width_height[1])
         surf_w = rot_surface.get_width()
         surf_h = rot_surface.get_height()
         x = (surf_w - width_height[0]) // 2
@@ -461,8 +488,8 @@ class Car:
         assert sub_rot_array_scaled_up.max() <= 255
 
         # Compute cost relative to position within the lane
-        x = np.ceil((surf_w - self._length) / 2)
-        y = np.ceil((surf_h - self.LANE_W) / 2)
+        x = math.ceil((surf_w - self._length) / 2)
+        y = math.ceil((surf_h - self.LANE_W) / 2)
         neighbourhood = rot_surface.subsurface(x, y, self._length, self.LANE_W)
         neighbourhood_array = pygame.surfarray.array3d(neighbourhood).transpose(1, 0, 2)  # flip x and y
         lanes = neighbourhood_array[:, :, 0]
@@ -474,10 +501,10 @@ class Car:
         alpha = 1 * self.SCALE  # 1 m overlap collision
         # Create separable proximity mask
         crop_h, crop_w, _ = sub_rot_array.shape
-        max_x = np.ceil((crop_w - max(self._length - alpha, 0)) / 2)
-        max_y = np.ceil((crop_h - max(self._width - alpha, 0)) / 2)
-        min_x = max(np.ceil(max_x - self.safe_distance), 0)
-        min_y = np.ceil(crop_h / 2 - self._width)  # assumes other._width / 2 = self._width / 2
+        max_x = math.ceil((crop_w - max(self._length - alpha, 0)) / 2)
+        max_y = math.ceil((crop_h - max(self._width - alpha, 0)) / 2)
+        min_x = max(math.ceil(max_x - self.safe_distance), 0)
+        min_y = math.ceil(crop_h / 2 - self._width)  # assumes other._width / 2 = self._width / 2
         x_filter = (1 - abs(np.linspace(-1, 1, crop_w))) * crop_w / 2  # 45 degree
         x_filter[x_filter > max_x] = max_x  # chop off top
         x_filter[x_filter < min_x] = min_x  # chop off bottom
@@ -611,7 +638,7 @@ class Car:
 
     @property
     def valid(self):
-        return self.back[0] > self.look_ahead and self.front[0] < self.screen_w - 1.75 * self.look_ahead
+        return self._position[0] > self.look_ahead and self._front_x < self.screen_w - 1.75 * self.look_ahead
 
     def __repr__(self) -> str:
         cls = self.__class__
@@ -650,6 +677,8 @@ class Simulator(core.Env):
         self.lanes = self.build_lanes(nb_lanes)  # create lanes object, list of dicts
         self.vehicles = None  # vehicles list
         self.traffic_rate = traffic_rate  # new cars per second
+        self._spawn_rate = traffic_rate * self.delta_t  # new cars per frame, at the traffic peak
+        self._omega = 2 * math.pi * self.delta_t  # traffic modulation, radians per frame
         self.lane_occupancy = None  # keeps track of what vehicle are in each lane
         self.collision = None  # an accident happened
         self.episode = 0  # episode counter
@@ -745,43 +774,51 @@ class Simulator(core.Env):
     def step(self, policy_action=None):
 
         self.collision = False
-        # Free lane beginnings
-        # free_lanes = set(range(self.nb_lanes))
-        free_lanes = set(range(1, self.nb_lanes))
+        # Free lane beginnings, as a bit mask: bit l set <-> lane l is free
+        # free_mask = (1 << self.nb_lanes) - 1
+        free_mask = (1 << self.nb_lanes) - 2  # lane 0 reserved
+
+        screen_w = self.screen_size[0]
 
         # For every vehicle
         #   t <- t + dt
         #   leave or enter lane
         #   remove itself if out of screen
         #   update free lane beginnings
-        for v in self.vehicles[:]:
+        for v in self.vehicles:
             lanes_occupied = v.get_lane_set(self.lanes)
-            # Check for any passing and update lane_occupancy
-            for l in range(self.nb_lanes):
-                if l in lanes_occupied and v not in self.lane_occupancy[l]:
+            # Check for any passing and update lane_occupancy, only for the lanes that changed
+            if lanes_occupied != v._lane_set:
+                for l in lanes_occupied - v._lane_set:
                     # Enter lane
                     bisect.insort(self.lane_occupancy[l], v)
-                elif l not in lanes_occupied and v in self.lane_occupancy[l]:
+                for l in v._lane_set - lanes_occupied:
                     # Leave lane
                     self.lane_occupancy[l].remove(v)
-            # Remove from the environment cars outside the screen
-            if v.back[0] > self.screen_size[0]:
+                v._lane_set = lanes_occupied
+            # Remove from the lanes cars outside the screen
+            if v.back[0] > screen_w:
                 for l in lanes_occupied: self.lane_occupancy[l].remove(v)
-                self.vehicles.remove(v)
 
             # Update available lane beginnings
             if v.back[0] < v.safe_distance:  # at most safe_distance ahead
-                free_lanes -= lanes_occupied
+                free_mask &= ~v.get_lane_mask()
 
-        # Randomly add vehicles, up to 1 / dt per second
-        if random.random() < self.traffic_rate * np.sin(2 * np.pi * self.frame * self.delta_t) * self.delta_t:
-            if free_lanes:
+        # Remove from the environment cars outside the screen, in a single pass
+        self.vehicles = [v for v in self.vehicles if v.back[0] <= screen_w]
+
+        # Randomly add vehicles, up to 1 / dt per second (none while the modulation is negative)
+        modulation = math.sin(self._omega * self.frame)
+        if modulation > 0 and random.random() < self._spawn_rate * modulation:
+            if free_mask:
+                free_lanes = tuple(l for l in range(self.nb_lanes) if free_mask >> l & 1)
                 car = self.EnvCar(self.lanes, free_lanes, self.delta_t, self.next_car_id,
                                   self.look_ahead, self.screen_size[0], self.font[20], policy_type=self.policy_type,
                                   policy_network=self.policy_network)
                 self.next_car_id += 1
                 self.vehicles.append(car)
-                for l in car.get_lane_set(self.lanes):
+                car._lane_set = car.get_lane_set(self.lanes)
+                for l in car._lane_set:
                     # Prepend the new car to each lane it can be found
                     self.lane_occupancy[l].insert(0, car)
 
@@ -790,31 +827,20 @@ class Simulator(core.Env):
 
         # Generate state representation for each vehicle
 
-        # remove vehicles that need to be removed first
-        for v in self.vehicles:
-            lane_set = v.get_lane_set(self.lanes)
-            if len(lane_set) == 0:
-                lanes_occupied = v.get_lane_set(self.lanes)
-                for l in lanes_occupied: self.lane_occupancy[l].remove(v)
-                self.vehicles.remove(v)
+        # remove vehicles that need to be removed first (off the lanes, hence already out of lane_occupancy)
+        self.vehicles = [v for v in self.vehicles if v._lane_set]
 
         states_images, states_raw, update = [], [], []
         # print(len(self.vehicles))
         for v in self.vehicles:
-            lane_set = v.get_lane_set(self.lanes)
+            lane_set = v._lane_set  # computed once per frame, at the top of step()
             # If v is in one lane only
             # Provide a list of (up to) 6 neighbouring vehicles
-            if len(lane_set) == 0:
-                lanes_occupied = v.get_lane_set(self.lanes)
-                for l in lanes_occupied: self.lane_occupancy[l].remove(v)
-                self.vehicles.remove(v)
-                continue
-
-            current_lane_idx = lane_set.pop()
+            current_lane_idx = min(lane_set)
 
             # Given that I'm not in the left/right-most lane
             left_vehicles = self._get_neighbours(current_lane_idx, - 1, v) \
-                if current_lane_idx > 0 and len(lane_set) == 0 else None
+                if current_lane_idx > 0 and len(lane_set) == 1 else None
             mid_vehicles = self._get_neighbours(current_lane_idx, 0, v)
             right_vehicles = self._get_neighbours(current_lane_idx, + 1, v) \
                 if current_lane_idx < len(self.lanes) - 1 else None
@@ -893,14 +919,23 @@ class Simulator(core.Env):
         return None, None, False, self.vehicles
 
     def _get_neighbours(self, current_lane_idx, d_lane, v):
-        # Shallow copy the target lane
-        target_lane = self.lane_occupancy[current_lane_idx + d_lane][:]
-        # If I find myself in the target list, remove me
-        if v in target_lane: target_lane.remove(v)
-        # Find me in the lane
-        my_idx = bisect.bisect(target_lane, v)
-        behind = target_lane[my_idx - 1] if my_idx > 0 else None
-        ahead = target_lane[my_idx] if my_idx < len(target_lane) else None
+        target_lane = self.lane_occupancy[current_lane_idx + d_lane]
+        # If I find myself in the target list, leave me out (index i of the lane without me is i + (i >= me))
+        try:
+            me = target_lane.index(v)
+            n = len(target_lane) - 1
+        except ValueError:
+            me = n = len(target_lane)
+        # Find me in the lane, same probes as bisect.bisect on the lane without me (lanes are not always sorted)
+        lo, hi = 0, n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if v < target_lane[mid + (mid >= me)]:
+                hi = mid
+            else:
+                lo = mid + 1
+        behind = target_lane[lo - 1 + (lo - 1 >= me)] if lo > 0 else None
+        ahead = target_lane[lo + (lo >= me)] if lo < n else None
 
         return behind, ahead
 
@@ -916,16 +951,26 @@ class Simulator(core.Env):
             fps = int(1 / self.clock.tick(self.fps) * 1e3)
             self.mean_fps = 0.9 * self.mean_fps + 0.1 * fps if self.mean_fps is not None else fps
 
-            # clear the screen
-            self.screen.fill(colours['k'])
+            # static background (black, pictures and lanes), drawn once and then reused
+            try:
+                background = self._lane_surfaces['background']
 
-            # background pictures
-            if self.photos:
-                for i in range(len(self.photos)):
-                    self.screen.blit(self.photos[i], self.photos_rect[i])
+            except KeyError:
+                background = pygame.Surface(self.screen_size)
 
-            # draw lanes
-            self._draw_lanes(self.screen)
+                # clear the screen
+                background.fill(colours['k'])
+
+                # background pictures
+                if self.photos:
+                    for i in range(len(self.photos)):
+                        background.blit(self.photos[i], self.photos_rect[i])
+
+                # draw lanes
+                self._draw_lanes(background)
+                self._lane_surfaces['background'] = background
+
+            self.screen.blit(background, (0, 0))
 
             for v in self.vehicles:
                 v.draw(self.screen)
@@ -954,7 +999,7 @@ class Simulator(core.Env):
             #     self.collision = False
 
         if mode == 'machine':
-            max_extension = int(np.linalg.norm(width_height) / 2)
+            max_extension = int(math.hypot(*width_height) / 2)
             machine_screen_size = np.array(self.screen_size) + 2 * max_extension
             vehicle_surface = pygame.Surface(machine_screen_size)
 
@@ -965,6 +1010,7 @@ class Simulator(core.Env):
             except KeyError:
                 lane_surface = pygame.Surface(machine_screen_size)
                 self._draw_lanes(lane_surface, mode=mode, offset=max_extension)
+                self._lane_surfaces[mode] = lane_surface
 
             # # draw vehicles
             # for v in self.vehicles:
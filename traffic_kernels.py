@@ -0,0 +1,54 @@
+# Simulator kernels, JIT compiled by Numba (cached on disk after the first run).
+# To skip the JIT warm up altogether, build them ahead of time with
+#   python traffic_kernels.py
+# which writes the _traffic_kernels extension module next to this file.
+# traffic_gym prefers that module when present: rebuild it (or delete it) after editing any kernel below,
+# otherwise the stale build keeps running.
+
+import math
+
+try:
+    from numba import njit
+except ImportError:  # run the very same kernels as plain Python
+    def njit(*args, **kwargs):
+        return lambda f: f
+
+# Kernel signature, shared by the JIT and the ahead-of-time builds
+ADVANCE_SIGNATURE = 'f8(f8[:], f8[:], f8, f8, f8, f8)'
+
+
+@njit(ADVANCE_SIGNATURE, cache=True, fastmath=True, boundscheck=False)
+def advance(position, direction, speed, a, b, dt):
+    """
+    Integrate one car state by dt, in place
+    :param position: (x, y) position, updated in place
+    :param direction: (x, y) unit heading, updated in place
+    :param speed: current speed
+    :param a: acceleration action
+    :param b: steering action
+    :param dt: temporal updating interval
+    :return: new speed
+    """
+    dx, dy = direction[0], direction[1]
+
+    # State integration
+    position[0] += speed * dx * dt
+    position[1] += speed * dy * dt
+
+    # Steer along the ortho direction (dy, -dx)
+    k = b * speed * dt
+    vx = dx + dy * k
+    vy = dy - dx * k
+    norm = math.sqrt(vx * vx + vy * vy) + 1e-3
+    direction[0] = vx / norm
+    direction[1] = vy / norm
+
+    return speed + a * dt
+
+
+if __name__ == '__main__':
+    # Ahead-of-time build, pycc is only imported here, never at run time
+    from numba.pycc import CC
+    cc = CC('_traffic_kernels')
+    cc.export('advance', ADVANCE_SIGNATURE)(advance.py_func)
+    cc.compile()